@@ -8,6 +8,7 @@ from tensorflow.keras.layers import (
     LeakyReLU,
     Reshape,
     Conv2DTranspose,
+    Lambda,
     Activation,
 )
 from preprocess import load_image_batch
@@ -15,9 +16,7 @@ import tensorflow_gan as tfgan
 import tensorflow_hub as hub
 from tqdm import tqdm
 
-import numpy as np
-
-from imageio import imwrite
+from concurrent.futures import ThreadPoolExecutor
 import os
 import argparse
 
@@ -36,7 +35,7 @@ parser.add_argument(
     "--img-dir",
     type=str,
     default="./data/celebA",
-    help="Data where training images live",
+    help="Data where training images live, either JPEGs or the shards written by convert_tfrecords.py",
 )
 
 parser.add_argument(
@@ -46,6 +45,19 @@ parser.add_argument(
     help="Data where sampled output images will be written",
 )
 
+parser.add_argument(
+    "--snapshot-dir",
+    type=str,
+    default=None,
+    help="Where to persist the decoded training images between runs, eg. ./cache/celebA-snap (off if not given)",
+)
+
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="Use this flag to re-read the training images every epoch instead of keeping them in memory (about 4.9 GB for celebA)",
+)
+
 parser.add_argument(
     "--mode", type=str, default="train", help='Can be "train" or "test"'
 )
@@ -70,8 +82,8 @@ parser.add_argument(
 parser.add_argument(
     "--num-data-threads",
     type=int,
-    default=2,
-    help="Number of threads to use when loading & pre-processing training images",
+    default=-1,
+    help="Number of threads to use when loading & pre-processing training images (-1 lets tf.data tune this)",
 )
 
 parser.add_argument(
@@ -106,30 +118,33 @@ parser.add_argument(
 parser.add_argument(
     "--save-every",
     type=int,
-    default=500,
-    help="Save the state of the network after every [this many] training iterations",
+    default=1000,
+    help="Save the state of the network after every [this many] training iterations, counted across epochs (an epoch of celebA is about 1580 at the default batch size)",
 )
 
 parser.add_argument(
     "--device",
     type=str,
     default="GPU:0" if gpu_available else "CPU:0",
-    help="specific the device of computation eg. CPU:0, GPU:0, GPU:1, GPU:2, ... ",
+    help="specific the device of computation eg. CPU:0, GPU:0, GPU:1, GPU:2, ... (ignored when several GPUs are visible, they are all used)",
 )
 
-args = parser.parse_args()
-
-## --------------------------------------------------------------------------------------
-
-# Numerically stable logarithm function
-def log(x):
-    """
-    Finds the stable log of x
+parser.add_argument(
+    "--fid-samples",
+    type=int,
+    default=2048,
+    help="Number of real and of generated images the end-of-epoch FID is computed over (more than inception's 1001 features)",
+)
 
-    :param x: 
-    """
-    return tf.math.log(tf.maximum(x, 1e-5))
+parser.add_argument(
+    "--upsampling",
+    type=str,
+    default="resize",
+    choices=["resize", "transpose"],
+    help='How the generator upsamples: "resize" (upsample + conv) or "transpose" (transposed conv)',
+)
 
+args = parser.parse_args()
 
 ## --------------------------------------------------------------------------------------
 
@@ -147,43 +162,106 @@ module = tf.keras.Sequential(
 )
 
 
-def fid_function(real_image_batch, generated_image_batch):
+INCEPTION_IMAGE_SIZE = (299, 299)
+# Built once here rather than on every call
+module.build([None, *INCEPTION_IMAGE_SIZE, 3])
+
+
+@tf.function
+def inception_features(image_batch):
     """
-    Given a batch of real images and a batch of generated images, this function pulls down a pre-trained inception 
-    v3 network and then uses it to extract the activations for both the real and generated images. The distance of 
-    these activations is then computed. The distance is a measure of how "realistic" the generated images are.
+    Resizes a batch of images to the inception input size and extracts the pre-trained inception v3 network's 
+    activations for them, within a single graph.
+
+    :param image_batch: a batch of real or generated images, shape=[batch_size, height, width, channels]
 
-    :param real_image_batch: a batch of real images from the dataset, shape=[batch_size, height, width, channels]
-    :param generated_image_batch: a batch of images generated by the generator network, shape=[batch_size, height, width, channels]
+    :return: the inception activations, shape=[batch_size, 1001]
+    """
+    resized = tf.image.resize(tf.cast(image_batch, tf.float32), INCEPTION_IMAGE_SIZE)
+    return module(resized)
+
+
+def generated_features(generator, num_images):
+    """
+    Samples images from the generator as it is now and extracts their inception activations.
+
+    :param generator: generator model
+    :param num_images: how many generated images to extract activations for
+
+    :return: the inception activations, shape=[num_images, 1001]
+    """
+    features = []
+    for _ in range(-(-num_images // args.batch_size)):
+        noise = tf.random.normal([args.batch_size, args.z_dim])
+        features.append(inception_features(generator(noise)))
+    return tf.concat(features, 0)[:num_images]
+
+
+def fid_function(real_features, fake_features):
+    """
+    Given the inception activations accumulated for real and generated images, this function computes the distance 
+    between them. The distance is a measure of how "realistic" the generated images are. FID is biased by the number 
+    of samples it sees, and the covariances are rank deficient with fewer samples than features, so it should be 
+    computed over more than 1001 images of each rather than one batch at a time.
+
+    :param real_features: inception activations of real images, shape=[num_images, 1001]
+    :param fake_features: inception activations of generated images, shape=[num_images, 1001]
 
     :return: the inception distance between the real and generated images, scalar
     """
-    INCEPTION_IMAGE_SIZE = (299, 299)
-    real_resized = tf.image.resize(real_image_batch, INCEPTION_IMAGE_SIZE)
-    fake_resized = tf.image.resize(generated_image_batch, INCEPTION_IMAGE_SIZE)
-    module.build([None, 299, 299, 3])
-    real_features = module(real_resized)
-    fake_features = module(fake_resized)
+    # The covariance square root is sensitive to precision loss, so compute it in float64
     return tfgan.eval.frechet_classifier_distance_from_activations(
-        real_features, fake_features
+        tf.cast(real_features, tf.float64), tf.cast(fake_features, tf.float64)
     )
 
 
+def upsample_nearest(x):
+    """
+    Doubles the height and width of a batch of feature maps by repeating every pixel. Same result as UpSampling2D, 
+    but its gradient is a plain sum, whereas XLA has no kernel for ResizeNearestNeighborGrad.
+
+    :param x: a batch of feature maps, shape=[batch_size, height, width, channels]
+
+    :return: the upsampled feature maps, shape=[batch_size, 2 * height, 2 * width, channels]
+    """
+    return tf.repeat(tf.repeat(x, 2, axis=1), 2, axis=2)
+
+
 def deconv_block(size, is_last_layer=False):
-    block = [
-        Conv2DTranspose(
-            size,
-            4,
-            2,
-            "SAME",
-            use_bias=False,
-            activation="tanh" if is_last_layer else None,
-            kernel_initializer=tf.random_normal_initializer(stddev=0.02),
-        )
-    ]
+    if args.upsampling == "resize":
+        # Nearest-neighbour upsample then a stride-1 conv: same output shape, but it stays on the fast forward-conv
+        # kernels and avoids checkerboard artifacts
+        block = [
+            Lambda(upsample_nearest),
+            Conv2D(
+                size,
+                3,
+                1,
+                "SAME",
+                use_bias=False,
+                activation="tanh" if is_last_layer else None,
+                kernel_initializer=tf.random_normal_initializer(stddev=0.02),
+            ),
+        ]
+    else:
+        block = [
+            Conv2DTranspose(
+                size,
+                4,
+                2,
+                "SAME",
+                use_bias=False,
+                activation="tanh" if is_last_layer else None,
+                kernel_initializer=tf.random_normal_initializer(stddev=0.02),
+            )
+        ]
 
     if not is_last_layer:
-        block += [LeakyReLU(alpha=0.2), BatchNormalization()]
+        # Conv -> BN -> ReLU is the pattern XLA and the cuDNN remapper fuse best
+        block += [BatchNormalization(), Activation("relu")]
+    else:
+        # Keep the generated images in float32 under mixed precision
+        block += [Activation("linear", dtype="float32")]
 
     return block
 
@@ -216,11 +294,18 @@ class Generator_Model(tf.keras.Model):
         # TODO: Define the model, loss, and optimizer
 
         layers = [
-            # Project and reshape (Input is bsz * z-dim)
-            Dense(4 * 4 * 512, activation="relu", use_bias=False),
-            Reshape([4, 4, 512]),
-            LeakyReLU(alpha=0.02),
+            # Project and reshape (Input is bsz * z-dim), as a 4x4 transposed conv over a 1x1 "image" of the noise
+            Reshape([1, 1, args.z_dim]),
+            Conv2DTranspose(
+                512,
+                4,
+                1,
+                "VALID",
+                use_bias=False,
+                kernel_initializer=tf.random_normal_initializer(stddev=0.02),
+            ),
             BatchNormalization(),
+            Activation("relu"),
             # First Deconv to 8x8x512, filters 4, stride 2
             *deconv_block(256),
             *deconv_block(128),
@@ -231,30 +316,31 @@ class Generator_Model(tf.keras.Model):
         self.net = Sequential(layers)
 
     @tf.function
-    def call(self, inputs):
+    def call(self, inputs, training=False):
         """
         Executes the generator model on the random noise vectors.
 
         :param inputs: a batch of random noise vectors, shape=[batch_size, z_dim]
+        :param training: whether batch normalization should use (and update) batch statistics
 
         :return: prescaled generated images, shape=[batch_size, height, width, channel]
         """
         # TODO: Call the forward pass
-        return self.net(inputs)
+        return self.net(inputs, training=training)
 
     @tf.function
     def loss_function(self, disc_fake_output):
         """
         Outputs the loss given the discriminator output on the generated images.
 
-        :param disc_fake_output: the discrimator output on the generated images, shape=[batch_size,1]
+        :param disc_fake_output: the discrimator logits on the generated images, shape=[batch_size,1]
 
         :return: loss, the cross entropy loss, scalar
         """
         # TODO: Calculate the loss
         return tf.reduce_mean(
-            tf.keras.losses.binary_crossentropy(
-                tf.ones_like(disc_fake_output), disc_fake_output
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=tf.ones_like(disc_fake_output), logits=disc_fake_output
             )
         )
 
@@ -273,41 +359,44 @@ class Discriminator_Model(tf.keras.Model):
             *conv_block(256),
             *conv_block(512),
             Flatten(),
-            Dense(1, activation="sigmoid"),
+            Dense(1),
+            # Raw logits, kept in float32 under mixed precision; the losses apply the sigmoid themselves
+            Activation("linear", dtype="float32"),
         ]
 
         self.net = Sequential(layers)
 
     @tf.function
-    def call(self, inputs):
+    def call(self, inputs, training=False):
         """
         Executes the discriminator model on a batch of input images and outputs whether it is real or fake.
 
         :param inputs: a batch of images, shape=[batch_size, height, width, channels]
+        :param training: whether batch normalization should use (and update) batch statistics
 
-        :return: a batch of values indicating whether the image is real or fake, shape=[batch_size, 1]
+        :return: a batch of logits indicating whether the image is real or fake, shape=[batch_size, 1]
         """
         # TODO: Call the forward pass
-        return self.net(inputs)
+        return self.net(inputs, training=training)
 
     def loss_function(self, disc_real_output, disc_fake_output):
         """
         Outputs the discriminator loss given the discriminator model output on the real and generated images.
 
-        :param disc_real_output: discriminator output on the real images, shape=[batch_size, 1]
-        :param disc_fake_output: discriminator output on the generated images, shape=[batch_size, 1]
+        :param disc_real_output: discriminator logits on the real images, shape=[batch_size, 1]
+        :param disc_fake_output: discriminator logits on the generated images, shape=[batch_size, 1]
 
         :return: loss, the combined cross entropy loss, scalar
         """
         # TODO: Calculate the loss
         loss = tf.reduce_mean(
-            tf.keras.losses.binary_crossentropy(
-                tf.zeros_like(disc_fake_output), disc_fake_output
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=tf.zeros_like(disc_fake_output), logits=disc_fake_output
             )
         )
         loss += tf.reduce_mean(
-            tf.keras.losses.binary_crossentropy(
-                tf.ones_like(disc_real_output), disc_real_output
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=tf.ones_like(disc_real_output), logits=disc_real_output
             )
         )
 
@@ -317,76 +406,189 @@ class Discriminator_Model(tf.keras.Model):
 ## --------------------------------------------------------------------------------------
 
 
-def gen_noise():
-    return tf.random.uniform([args.batch_size, args.z_dim], minval=-1, maxval=1)
-
-
-# Train the model for one epoch.
-def train(generator, discriminator, dataset_iterator, manager):
+def make_train_steps(strategy, generator, discriminator, g_optimizer, d_optimizer):
     """
-    Train the model for one epoch. Save a checkpoint every 500 or so batches.
+    Builds the training steps for the given models and optimizers. The forward pass, the losses, the gradients and 
+    the optimizer updates all run inside a single compiled graph, so no Python runs between the layers of a step. 
+    Each batch is split across the strategy's replicas and the gradients are summed between them. Must be called 
+    within strategy.scope().
+
+    Two steps are built, so that whether the discriminator is updated is decided in Python rather than by a tf.cond: 
+    apply_gradients syncs the replicas, and tf.distribute doesn't allow that inside control flow.
 
+    :param strategy: the tf.distribute strategy the models and optimizers were created under
     :param generator: generator model
     :param discriminator: discriminator model
-    :param dataset_ierator: iterator over dataset, see preprocess.py for more information
-    :param manager: the manager that handles saving checkpoints by calling save()
+    :param g_optimizer: loss scale optimizer that updates the generator's variables
+    :param d_optimizer: loss scale optimizer that updates the discriminator's variables
 
-    :return: The average FID score over the epoch
+    :return: a step that only updates the generator, taking a distributed batch and returning g_loss, and a step 
+    that updates both networks, returning (g_loss, d_loss)
     """
+    num_replicas = strategy.num_replicas_in_sync
+    if args.batch_size % num_replicas != 0:
+        raise ValueError(
+            "batch size %d is not divisible by the %d replicas"
+            % (args.batch_size, num_replicas)
+        )
 
-    pbar = tqdm(dataset_iterator)
-    total_fid = 0
-    total_fid_n = 0
-
-    g_optimizer = tf.keras.optimizers.Adam(
-        learning_rate=args.learn_rate, beta_1=args.beta1
+    # Refilled in place every step instead of allocating a fresh noise tensor. The pipeline drops the remainder, so
+    # every replica always sees the same share of args.batch_size. ON_READ gives each replica its own copy
+    noise_buffer = tf.Variable(
+        tf.zeros([args.batch_size // num_replicas, args.z_dim]),
+        trainable=False,
+        name="noise",
+        synchronization=tf.VariableSynchronization.ON_READ,
+        aggregation=tf.VariableAggregation.NONE,
     )
 
-    d_optimizer = tf.keras.optimizers.Adam(
-        learning_rate=args.learn_rate, beta_1=args.beta1
-    )
+    def update_generator():
+        """
+        Updates the generator on one replica.
 
-    # Loop over our data until we run out
-    for iteration, batch in enumerate(pbar):
-        # TODO: Train the model
+        :return: this replica's share of the generator loss, its generated images and the generator's gradients
+        """
+        # Sample the latent vectors on-device, inside the compiled step
+        noise_buffer.assign(tf.random.normal(noise_buffer.shape))
+        noise = noise_buffer.read_value()
+
+        with tf.GradientTape() as tape_g:
+            gen_output = generator(noise, training=True)
+            logits_fake = discriminator(gen_output, training=True)
+            # Gradients are summed across replicas, so each contributes its share of the mean
+            g_loss = generator.loss_function(logits_fake) / num_replicas
+            # Scale the loss up so float16 gradients don't underflow
+            scaled_g_loss = g_optimizer.get_scaled_loss(g_loss)
+
+        g_gradients = g_optimizer.get_unscaled_gradients(
+            tape_g.gradient(scaled_g_loss, generator.trainable_variables)
+        )
+        return g_loss, gen_output, g_gradients
 
-        gen_input = gen_noise()
+    @tf.function(jit_compile=True)
+    def g_step(batch):
+        """
+        Runs one generator-only training iteration on one replica.
 
-        with tf.GradientTape() as gtape, tf.GradientTape() as dtape:
-            gen_output = generator(gen_input)
+        :param batch: this replica's share of the real images, unused, shape=[batch_size, height, width, channels]
 
-            real_output = discriminator(gen_output)
-            fake_output = discriminator(batch)
+        :return: this replica's share of the generator loss
+        """
+        g_loss, _, g_gradients = update_generator()
+        g_optimizer.apply_gradients(zip(g_gradients, generator.trainable_variables))
+        return g_loss
 
-            g_loss = generator.loss_function(real_output)
+    @tf.function(jit_compile=True)
+    def gd_step(batch):
+        """
+        Runs one training iteration that updates both networks on one replica.
 
-            if iteration % args.num_gen_updates == 0:
-                d_loss = discriminator.loss_function(fake_output, real_output)
+        :param batch: this replica's share of the real images, shape=[batch_size, height, width, channels]
 
-        pbar.set_description("g_loss: {:1.3f}, d_loss: {:1.3f}".format(g_loss, d_loss))
+        :return: this replica's share of the generator loss and the discriminator loss
+        """
+        # The generator's gradients are taken before the discriminator pass so its activations can be freed
+        g_loss, gen_output, g_gradients = update_generator()
+
+        # Stopping the gradient keeps the generator's ops off the discriminator tape
+        with tf.GradientTape() as tape_d:
+            logits_fake = discriminator(tf.stop_gradient(gen_output), training=True)
+            logits_real = discriminator(batch, training=True)
+            d_loss = (
+                discriminator.loss_function(logits_real, logits_fake) / num_replicas
+            )
+            scaled_d_loss = d_optimizer.get_scaled_loss(d_loss)
+
+        d_gradients = d_optimizer.get_unscaled_gradients(
+            tape_d.gradient(scaled_d_loss, discriminator.trainable_variables)
+        )
 
-        g_gradients = gtape.gradient(g_loss, generator.trainable_variables)
+        # Both updates are applied after both losses, so each sees the other network's pre-step weights
         g_optimizer.apply_gradients(zip(g_gradients, generator.trainable_variables))
+        d_optimizer.apply_gradients(zip(d_gradients, discriminator.trainable_variables))
+        return g_loss, d_loss
+
+    @tf.function
+    def distributed_g_step(batch):
+        g_loss = strategy.run(g_step, args=(batch,))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, g_loss, axis=None)
 
+    @tf.function
+    def distributed_gd_step(batch):
+        g_loss, d_loss = strategy.run(gd_step, args=(batch,))
+        return (
+            strategy.reduce(tf.distribute.ReduceOp.SUM, g_loss, axis=None),
+            strategy.reduce(tf.distribute.ReduceOp.SUM, d_loss, axis=None),
+        )
+
+    return distributed_g_step, distributed_gd_step
+
+
+# Train the model for one epoch.
+def train(
+    strategy,
+    generator,
+    g_step,
+    gd_step,
+    dataset_iterator,
+    manager,
+    start_step,
+    real_features=None,
+):
+    """
+    Train the model for one epoch. Save a checkpoint every args.save_every batches, counted from the first epoch.
+
+    :param strategy: the tf.distribute strategy the models were created under
+    :param generator: generator model, sampled at the end of the epoch for the FID
+    :param g_step: the compiled generator-only training step, see make_train_steps
+    :param gd_step: the compiled training step that updates both networks, see make_train_steps
+    :param dataset_ierator: iterator over the distributed dataset, see preprocess.py for more information
+    :param manager: the manager that handles saving checkpoints by calling save()
+    :param start_step: the number of training steps taken before this epoch
+    :param real_features: inception activations of the real reference images from an earlier epoch, collected from
+    this epoch's batches when None
+
+    :return: The FID score of the generator at the end of the epoch, and the real activations it was computed against
+    """
+
+    pbar = tqdm(dataset_iterator)
+    real_activations = []
+    num_real = 0 if real_features is None else args.fid_samples
+
+    # Loop over our data until we run out
+    for iteration, batch in enumerate(pbar):
+        # The discriminator is only updated once every num_gen_updates iterations
         if iteration % args.num_gen_updates == 0:
-            d_gradients = dtape.gradient(d_loss, discriminator.trainable_variables)
-            d_optimizer.apply_gradients(
-                zip(d_gradients, discriminator.trainable_variables)
+            g_loss, d_loss = gd_step(batch)
+        else:
+            g_loss = g_step(batch)
+
+        # Formatting the losses waits for the step to finish, so only do it every so often. d_loss is from the
+        # latest discriminator update, iteration 0 always is one
+        if iteration % args.log_every == 0:
+            pbar.set_description(
+                "g_loss: {:1.3f}, d_loss: {:1.3f}".format(g_loss, d_loss)
             )
 
-        # Save
-        if iteration % args.save_every == 0:
+        # Save, counting steps globally since an epoch can be shorter than save_every
+        if (start_step + iteration + 1) % args.save_every == 0:
             manager.save()
 
-        # Calculate inception distance and track the fid in order
-        # to return the average
-        if iteration % 500 == 0:
-            fid_ = fid_function(batch, gen_output)
-            total_fid += fid_
-            total_fid_n += 1
-            print("**** INCEPTION DISTANCE: %g ****" % fid_)
+        # Collect real inception activations until there are enough, the batches are already shuffled
+        if num_real < args.fid_samples:
+            real_activations.append(inception_features(strategy.gather(batch, axis=0)))
+            num_real += args.batch_size
+
+    # The real images are the same every epoch, so their activations are only computed once and every epoch's FID is
+    # measured against the same reference set
+    if real_features is None:
+        real_features = tf.concat(real_activations, 0)[: args.fid_samples]
 
-    return total_fid / total_fid_n
+    # Compare against the generator as it ends the epoch, not snapshots from along the way
+    fake_features = generated_features(generator, real_features.shape[0])
+    fid_ = fid_function(real_features, fake_features)
+    print("**** INCEPTION DISTANCE: %g ****" % fid_)
+    return fid_, real_features
 
 
 # Test the model by generating some samples.
@@ -399,37 +601,78 @@ def test(generator):
     :return: None
     """
     # TODO: Replace 'None' with code to sample a batch of random images
-    img = np.array(generator(gen_noise()))
+    img = generator(tf.random.normal([args.batch_size, args.z_dim]))
 
     ### Below, we've already provided code to save these generated images to files on disk
-    # Rescale the image from (-1, 1) to (0, 255)
-    img = ((img / 2) - 0.5) * 255
-    # Convert to uint8
-    img = img.astype(np.uint8)
-    # Save images to disk
-    for i in range(0, args.batch_size):
-        img_i = img[i]
-        s = args.out_dir + "/" + str(i) + ".png"
-        imwrite(s, img_i)
+    # Rescale the image from (-1, 1) to (0, 255) and convert to uint8
+    img = tf.saturate_cast((img + 1.0) * 127.5, tf.uint8)
+    # Encode the whole batch to PNG in native code
+    pngs = tf.map_fn(tf.io.encode_png, img, fn_output_signature=tf.string).numpy()
+
+    def write_png(i):
+        with open(args.out_dir + "/" + str(i) + ".png", "wb") as f:
+            f.write(pngs[i])
+
+    # Save images to disk concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(write_png, range(0, args.batch_size)))
 
 
 ## --------------------------------------------------------------------------------------
 
 
 def main():
+    # XLA-cluster the graphs outside the explicitly compiled train step (eg. the FID inception pass). Grappler's
+    # layout, remapping and folding rewrites are already on by default, so they need no setting here
+    tf.config.optimizer.set_jit("autoclustering")
+
+    # Run layers in float16 while keeping the variables (and Adam's state) in float32
+    tf.keras.mixed_precision.set_global_policy("mixed_float16")
+
     # Load a batch of images (to feed to the discriminator)
     dataset_iterator = load_image_batch(
-        args.img_dir, batch_size=args.batch_size, n_threads=args.num_data_threads
+        args.img_dir,
+        batch_size=args.batch_size,
+        n_threads=args.num_data_threads,
+        snapshot_dir=args.snapshot_dir,
+        cache=not args.no_cache,
     )
 
-    # Initialize generator and discriminator models
-    generator = Generator_Model()
-    discriminator = Discriminator_Model()
+    # Data-parallel over every visible GPU, otherwise just the one --device
+    if len(tf.config.list_logical_devices("GPU")) > 1:
+        strategy = tf.distribute.MirroredStrategy()
+    else:
+        strategy = tf.distribute.OneDeviceStrategy("/device:" + args.device)
+    print("Number of replicas: ", strategy.num_replicas_in_sync)
+
+    with strategy.scope():
+        # Initialize generator and discriminator models
+        generator = Generator_Model()
+        discriminator = Discriminator_Model()
+
+        # One optimizer per network, built once so Adam keeps its moment estimates across iterations
+        g_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+            tf.keras.optimizers.Adam(learning_rate=args.learn_rate, beta_1=args.beta1)
+        )
+        d_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+            tf.keras.optimizers.Adam(learning_rate=args.learn_rate, beta_1=args.beta1)
+        )
+        g_step, gd_step = make_train_steps(
+            strategy, generator, discriminator, g_optimizer, d_optimizer
+        )
+
+    # Splits each batch between the replicas
+    dataset_iterator = strategy.experimental_distribute_dataset(dataset_iterator)
 
     # For saving/loading models
     checkpoint_dir = "./checkpoints"
     checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
-    checkpoint = tf.train.Checkpoint(generator=generator, discriminator=discriminator)
+    checkpoint = tf.train.Checkpoint(
+        generator=generator,
+        discriminator=discriminator,
+        g_optimizer=g_optimizer,
+        d_optimizer=d_optimizer,
+    )
     manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=3)
     # Ensure the output directory exists
     if not os.path.exists(args.out_dir):
@@ -440,23 +683,31 @@ def main():
         checkpoint.restore(manager.latest_checkpoint).expect_partial()
 
     try:
-        # Specify an invalid GPU device
-        with tf.device("/device:" + args.device):
-            if args.mode == "train":
-                for epoch in range(0, args.num_epochs):
-                    print(
-                        "========================== EPOCH %d  =========================="
-                        % epoch
-                    )
-                    avg_fid = train(generator, discriminator, dataset_iterator, manager)
-                    print("Average FID for Epoch: " + str(avg_fid))
-                    # Save at the end of the epoch, too
-                    print("**** SAVING CHECKPOINT AT END OF EPOCH ****")
-                    manager.save()
-                    print("Running tests")
-                    test(generator)
-            if args.mode == "test":
+        if args.mode == "train":
+            real_features = None
+            for epoch in range(0, args.num_epochs):
+                print(
+                    "========================== EPOCH %d  =========================="
+                    % epoch
+                )
+                epoch_fid, real_features = train(
+                    strategy,
+                    generator,
+                    g_step,
+                    gd_step,
+                    dataset_iterator,
+                    manager,
+                    int(g_optimizer.iterations),
+                    real_features,
+                )
+                print("FID for Epoch: " + str(epoch_fid))
+                # Save at the end of the epoch, too
+                print("**** SAVING CHECKPOINT AT END OF EPOCH ****")
+                manager.save()
+                print("Running tests")
                 test(generator)
+        if args.mode == "test":
+            test(generator)
     except RuntimeError as e:
         print(e)
 
@@ -0,0 +1,69 @@
+import os
+import argparse
+import tensorflow as tf
+from tqdm import tqdm
+
+from preprocess import TFRECORD_PATTERN, load_and_process_image
+
+
+def bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def write_dataset(img_dir, out_dir, num_shards=64):
+    """
+    Converts every JPEG in img_dir into num_shards TFRecord files in out_dir. Each record stores the raw bytes of one
+    preprocessed float16 image, so training never has to decode or resize a JPEG again. load_image_batch reads the
+    shards instead of the JPEGs whenever it finds them in its directory, so by default they sit next to the JPEGs.
+
+    :param img_dir: directory containing the celebA JPEGs
+    :param out_dir: directory the shards will be written to
+    :param num_shards: number of TFRecord files to spread the images across
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    file_paths = tf.io.gfile.glob(os.path.join(img_dir, "*.jpg"))
+    if not file_paths:
+        raise ValueError("No .jpg files found in %s" % img_dir)
+    dataset = tf.data.Dataset.from_tensor_slices(file_paths).shuffle(len(file_paths))
+    dataset = dataset.map(load_and_process_image, num_parallel_calls=tf.data.AUTOTUNE)
+
+    shard_names = [
+        TFRECORD_PATTERN.replace("*", "%05d-of-%05d" % (i, num_shards))
+        for i in range(num_shards)
+    ]
+    writers = [tf.io.TFRecordWriter(os.path.join(out_dir, n)) for n in shard_names]
+    try:
+        for i, image in enumerate(tqdm(dataset, total=len(file_paths))):
+            example = tf.train.Example(
+                features=tf.train.Features(
+                    feature={"img": bytes_feature(image.numpy().tobytes())}
+                )
+            )
+            writers[i % num_shards].write(example.SerializeToString())
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert celebA JPEGs to TFRecords")
+    parser.add_argument(
+        "--img-dir",
+        type=str,
+        default="./data/celebA",
+        help="Data where training images live",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=str,
+        default="./data/celebA",
+        help="Directory the TFRecord shards will be written to, should match assignment.py's --img-dir",
+    )
+    parser.add_argument(
+        "--num-shards", type=int, default=64, help="Number of TFRecord shards to write"
+    )
+    args = parser.parse_args()
+
+    write_dataset(args.img_dir, args.out_dir, args.num_shards)
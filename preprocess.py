@@ -2,10 +2,58 @@ import numpy as np
 import tensorflow as tf
 import os
 
+# Images are stored pre-resized to this shape in the TFRecord shards
+IMAGE_SHAPE = [64, 64, 3]
+TFRECORD_PATTERN = "celebA-*.tfrecord"
+
+
+def parse_image_example(serialized):
+    """
+    Given a serialized tf.train.Example written by convert_tfrecords.py, this function recovers the image stored in it.
+
+    :param serialized: a scalar string tensor holding one serialized example
+
+    :return: an rgb image in the range (-1, 1), dtype=float16, shape=IMAGE_SHAPE
+    """
+    features = tf.io.parse_single_example(
+        serialized, {"img": tf.io.FixedLenFeature([], tf.string)}
+    )
+    image = tf.io.decode_raw(features["img"], tf.float16)
+    return tf.reshape(image, IMAGE_SHAPE)
+
+
+def load_and_process_image(file_path):
+    """
+    Given a file path, this function opens, decodes and resizes the image stored in the file. Both the JPEG path of
+    load_image_batch and convert_tfrecords.py use it, so the shards hold exactly what the JPEG path would produce.
+
+    :param file_path: path to a JPEG file
+
+    :return: an rgb image in the range (-1, 1), dtype=float16, shape=IMAGE_SHAPE
+    """
+    # Load image
+    image = tf.io.decode_jpeg(tf.io.read_file(file_path), channels=3)
+    # Convert image to normalized float (0, 1)
+    image = tf.image.convert_image_dtype(image, tf.float32)
+    # Resize to the shape the models expect (a no-op for images that are already 64x64)
+    image = tf.image.resize(image, IMAGE_SHAPE[:2])
+    # Rescale data to range (-1, 1)
+    image = (image - 0.5) * 2
+    # Match the dtype and static shape of the TFRecord shards, the models cast it back up on-device
+    return tf.ensure_shape(tf.cast(image, tf.float16), IMAGE_SHAPE)
+
 
 # Sets up tensorflow graph to load images
 # (This is the version using new-style tf.data API)
-def load_image_batch(dir_name, batch_size=128, shuffle_buffer_size=250000, n_threads=2):
+def load_image_batch(
+    dir_name,
+    batch_size=128,
+    shuffle_buffer_size=250000,
+    n_threads=tf.data.AUTOTUNE,
+    record_shuffle_buffer_size=25000,
+    snapshot_dir=None,
+    cache=True,
+):
     """
     Given a directory and a batch size, the following method returns a dataset iterator that can be queried for 
     a batch of images
@@ -14,45 +62,73 @@ def load_image_batch(dir_name, batch_size=128, shuffle_buffer_size=250000, n_thr
     :param batch_size: the batch size of images that will be trained on each time
     :param shuffle_buffer_size: representing the number of elements from this dataset from which the new dataset will 
     sample
-    :param n_thread: the number of threads that will be used to fetch the data
+    :param n_threads: the number of threads that will be used to fetch the data, tf.data.AUTOTUNE (-1) lets tf.data 
+    pick this at runtime
+    :param record_shuffle_buffer_size: the number of decoded images shuffled together each epoch. This window is all
+    that reorders the cached epochs and the TFRecord shards' records, so it is a deliberate trade-off: the whole
+    dataset (about 200000 for celebA) reshuffles fully, but training waits for the buffer to fill every epoch
+    :param snapshot_dir: if given, the decoded images are written here on the first run and read back on later runs
+    :param cache: whether to keep the decoded images in memory after the first epoch
 
     :return: an iterator into the dataset
     """
-    # Function used to load and pre-process image files
-    # (Have to define this ahead of time b/c Python does allow multi-line
-    #    lambdas, *grumble*)
-    def load_and_process_image(file_path):
-        """
-        Given a file path, this function opens and decodes the image stored in the file.
-
-        :param file_path: a batch of images
-
-        :return: an rgb image
-        """
-        # Load image
-        image = tf.io.decode_jpeg(tf.io.read_file(file_path), channels=3)
-        # Convert image to normalized float (0, 1)
-        image = tf.image.convert_image_dtype(image, tf.float32)
-        # Rescale data to range (-1, 1)
-        image = (image - 0.5) * 2
-        return image
-
-    # List file names/file paths
-    dir_path = dir_name + "/*.jpg"
-    dataset = tf.data.Dataset.list_files(dir_path)
-
-    # Shuffle order
-    dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
-
-    # Load and process images (in parallel)
-    dataset = dataset.map(map_func=load_and_process_image, num_parallel_calls=n_threads)
+    # Pre-converted shards (see convert_tfrecords.py) skip JPEG decoding entirely
+    record_paths = tf.io.gfile.glob(dir_name + "/" + TFRECORD_PATTERN)
+    if record_paths:
+        # Shuffle the shard order, then read several shards at once and mix their records
+        dataset = tf.data.Dataset.list_files(record_paths, shuffle=True)
+        dataset = dataset.interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=8,
+            num_parallel_calls=n_threads,
+            deterministic=False,
+        )
+        dataset = dataset.map(
+            map_func=parse_image_example,
+            num_parallel_calls=n_threads,
+            deterministic=False,
+        )
+    else:
+        # List file names/file paths
+        dir_path = dir_name + "/*.jpg"
+        dataset = tf.data.Dataset.list_files(dir_path)
+
+        # Shuffle order
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+
+        # Load and process images (in parallel). The order is already shuffled, so let finished images through first
+        dataset = dataset.map(
+            map_func=load_and_process_image,
+            num_parallel_calls=n_threads,
+            deterministic=False,
+        )
+
+    # Persist the decoded images across runs, so only the very first run pays for decoding
+    if snapshot_dir:
+        dataset = dataset.snapshot(snapshot_dir, compression="AUTO")
+
+    # Keep the decoded images in memory after the first epoch, so later epochs skip reading and decoding entirely
+    if cache:
+        dataset = dataset.cache()
+
+    # The cache replays the first epoch's order and the shards are read back in large runs, so reshuffle the decoded
+    # images every epoch. Uncached JPEGs already have their file names fully reshuffled above
+    if cache or record_paths:
+        dataset = dataset.shuffle(buffer_size=record_shuffle_buffer_size)
 
     # Create batch, dropping the final one which has less than batch_size elements and finally set to reshuffle
     # the dataset at the end of each iteration
     dataset = dataset.batch(batch_size, drop_remainder=True)
 
-    # Prefetch the next batch while the GPU is training
-    dataset = dataset.prefetch(1)
+    # Prefetch upcoming batches while the GPU is training, letting tf.data size the buffer
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+    # Ordering doesn't matter since everything is shuffled anyway
+    options = tf.data.Options()
+    options.deterministic = False
+    if n_threads > 0:
+        options.threading.private_threadpool_size = n_threads
+    dataset = dataset.with_options(options)
 
     # Return an iterator over this dataset
     return dataset